@@ -1,30 +1,95 @@
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import flask
 from flask import request
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import requests
+from requests.adapters import HTTPAdapter, Retry
+import redis
 import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 import logging
 
 logging.basicConfig(level=logging.INFO)
+
+class OrjsonProvider(DefaultJSONProvider):
+    # orjson always emits UTF-8 and compact separators, so ensure_ascii and
+    # separators are ignored; sort_keys and indent map to orjson options.
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = flask.Flask(__name__)
+app.json = OrjsonProvider(app)
 
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
 VPS_URL = os.environ.get('VPS_URL')
 API_KEY = os.environ.get('WORKER_API_KEY')
+REDIS_URL = os.environ['REDIS_URL']
+USER_STATE_TTL = 300
+WORKER_TIMEOUT = (5, 90) # (connect, read)
+TELEGRAM_TIMEOUT = 10
+REDIS_TIMEOUT = 2
+# Max updates handled at once per process (UPDATE_CONCURRENCY, default 16).
+# Under gevent workers gunicorn.conf.py sets it to worker_connections.
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 16))
 
 if SENTRY_DSN := os.environ.get('SENTRY_DSN'):
     sentry_sdk.init(dsn=SENTRY_DSN, integrations=[FlaskIntegration()], traces_sample_rate=1.0)
 
-user_states = {}
+redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT)
+
+def _make_session(retries, **headers):
+    session = requests.Session()
+    session.headers.update({'User-Agent': 'bot-bridge/1.0', **headers})
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=UPDATE_CONCURRENCY, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Kept-alive connections to the two hosts we talk to. The worker key is only
+# set on the worker session so it is never sent to Telegram. /execute is not
+# idempotent, so the worker session only retries failed connects, never reads.
+TELEGRAM_SESSION = _make_session(Retry(total=2, backoff_factor=0.2))
+WORKER_SESSION = _make_session(Retry(total=2, connect=2, read=0, other=0, backoff_factor=0.2), **{'X-Api-Key': API_KEY, 'Content-Type': 'application/json'})
+
+# Updates are processed off the request thread so Telegram gets its 200 right
+# away instead of waiting on the (up to 90 s) worker round-trip. Telegram will
+# not resend an update it got a 200 for, so only accept as many as can run
+# right away; the rest get a 503 and are redelivered by Telegram.
+_UPDATE_EXEC = ThreadPoolExecutor(max_workers=UPDATE_CONCURRENCY, thread_name_prefix='tg-update')
+_UPDATE_SLOTS = threading.BoundedSemaphore(UPDATE_CONCURRENCY)
+# Interim "working on it" messages go out on their own pool so they overlap
+# with the worker call instead of adding a Telegram round-trip before it. Each
+# in-flight update sends at most one, so size it the same.
+_SEND_EXEC = ThreadPoolExecutor(max_workers=UPDATE_CONCURRENCY, thread_name_prefix='tg-send')
+
+def set_user_state(chat_id, state):
+    redis_client.setex(f"state:{chat_id}", USER_STATE_TTL, orjson.dumps(state))
+
+def pop_user_state(chat_id):
+    raw = redis_client.getdel(f"state:{chat_id}")
+    return orjson.loads(raw) if raw is not None else None
+
+def clear_user_state(chat_id):
+    redis_client.delete(f"state:{chat_id}")
 
 def forward_task_to_worker(payload):
-    headers = {'X-Api-Key': API_KEY}
     try:
-        response = requests.post(f"{VPS_URL}/execute", json=payload, headers=headers, timeout=90)
+        response = WORKER_SESSION.post(f"{VPS_URL}/execute", data=orjson.dumps(payload), timeout=WORKER_TIMEOUT)
         response.raise_for_status()
-        return response.json().get('result', "Worker returned no result.")
-    except requests.exceptions.RequestException as e:
+        return orjson.loads(response.content).get('result', "Worker returned no result.")
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         logging.error(f"Could not connect to worker VPS: {e}")
         sentry_sdk.capture_exception(e)
         return "❌ Error: Could not connect to the processing server."
@@ -33,51 +98,113 @@ def send_telegram_message(chat_id, text):
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     payload = {'chat_id': chat_id, 'text': text}
     try:
-        requests.post(url, json=payload)
+        TELEGRAM_SESSION.post(url, json=payload, timeout=TELEGRAM_TIMEOUT)
     except Exception as e:
         logging.error(f"Failed to send Telegram message: {e}")
         sentry_sdk.capture_exception(e)
 
-@app.route('/webhook', methods=['POST'])
-def telegram_webhook():
-    update = request.get_json()
-    if 'message' not in update: return "OK", 200
-
+def _wait_for_ack(ack):
+    # Keep the acknowledgement ahead of the reply, but never let a stuck send
+    # hold up the update.
+    try:
+        ack.result(timeout=TELEGRAM_TIMEOUT)
+    except FutureTimeoutError:
+        logging.warning("Timed out waiting for Telegram acknowledgement; sending reply anyway.")
+
+def handle_start(chat_id, arg1, arg2):
+    send_telegram_message(chat_id, "Welcome! Use /add <service> <phone>")
+
+def handle_add(chat_id, service, phone):
+    if not phone:
+        send_telegram_message(chat_id, "Usage: /add <service> <phone_number>")
+        return
+    service = service.lower()
+
+    # Updates are acknowledged before they are handled, so the user's code can
+    # arrive while we are still waiting on the worker. Store the state first so
+    # that reply always finds it, and drop it again if no OTP went out.
+    try:
+        set_user_state(chat_id, {'service': service, 'phone': phone})
+    except redis.RedisError as e:
+        logging.error(f"Could not save user state: {e}")
+        sentry_sdk.capture_exception(e)
+        send_telegram_message(chat_id, "❌ Error: Could not start the request. Please try /add again.")
+        return
+
+    ack = _SEND_EXEC.submit(send_telegram_message, chat_id, f"Requesting OTP for {phone}...")
+    payload = {'command': 'send_otp', 'params': {'phone': phone, 'service': service}}
+    result = forward_task_to_worker(payload)
+    _wait_for_ack(ack)
+
+    if "OTP Sent" in result:
+        send_telegram_message(chat_id, f"✅ OTP sent successfully. Please reply with the code.")
+    else:
+        try:
+            clear_user_state(chat_id)
+        except redis.RedisError as e:
+            logging.error(f"Could not clear user state: {e}")
+            sentry_sdk.capture_exception(e)
+        send_telegram_message(chat_id, f"❌ Failed to send OTP. Worker response: {result}")
+
+# Add handlers for /list, /download etc. here
+COMMAND_HANDLERS = {
+    'start': handle_start,
+    'add': handle_add,
+}
+
+COMMAND_RE = re.compile(r'^/(\S+)(?:\s+(\S+))?(?:\s+(\S+))?')
+
+def handle_update(update):
     chat_id = update['message']['chat']['id']
     text = update['message'].get('text', '')
 
     if text.startswith('/'):
-        parts = text.split()
-        command = parts[0].lower()
-
-        if command == '/start':
-            send_telegram_message(chat_id, "Welcome! Use /add <service> <phone>")
-
-        elif command == '/add':
-            try:
-                service, phone = parts[1].lower(), parts[2]
-
-                send_telegram_message(chat_id, f"Requesting OTP for {phone}...")
-                payload = {'command': 'send_otp', 'params': {'phone': phone, 'service': service}}
-                result = forward_task_to_worker(payload)
+        if match := COMMAND_RE.match(text):
+            command, arg1, arg2 = match.group(1, 2, 3)
+            if handler := COMMAND_HANDLERS.get(command.lower()):
+                handler(chat_id, arg1, arg2)
+        return
 
-                if "OTP Sent" in result:
-                    user_states[chat_id] = {'service': service, 'phone': phone}
-                    send_telegram_message(chat_id, f"✅ OTP sent successfully. Please reply with the code.")
-                else:
-                    send_telegram_message(chat_id, f"❌ Failed to send OTP. Worker response: {result}")
-
-            except IndexError:
-                send_telegram_message(chat_id, "Usage: /add <service> <phone_number>")
-
-        # Add handlers for /list, /download etc. here
+    try:
+        state = pop_user_state(chat_id)
+    except redis.RedisError as e:
+        logging.error(f"Could not load user state: {e}")
+        sentry_sdk.capture_exception(e)
+        send_telegram_message(chat_id, "❌ Error: Could not check your pending request. Please try again.")
+        return
 
-    elif chat_id in user_states: # This part handles the user's OTP reply
-        state = user_states.pop(chat_id)
+    if state is not None: # This part handles the user's OTP reply
         otp = text
-        send_telegram_message(chat_id, f"Verifying OTP for {state['phone']}...")
+        ack = _SEND_EXEC.submit(send_telegram_message, chat_id, f"Verifying OTP for {state['phone']}...")
         payload = {'command': 'login', 'params': {**state, 'otp': otp, 'chat_id': chat_id}}
         result = forward_task_to_worker(payload)
+        _wait_for_ack(ack)
         send_telegram_message(chat_id, result)
+    else:
+        send_telegram_message(chat_id, "Please use /add <service> <phone_number> first.")
+
+def _handle_update_safely(update):
+    try:
+        handle_update(update)
+    except Exception as e:
+        logging.error(f"Failed to handle update: {e}")
+        sentry_sdk.capture_exception(e)
+    finally:
+        _UPDATE_SLOTS.release()
+
+def drain_pending_updates():
+    # Called from gunicorn's worker_exit hook so accepted updates finish
+    # before the process goes away.
+    _UPDATE_EXEC.shutdown(wait=True)
+    _SEND_EXEC.shutdown(wait=True)
+
+@app.route('/webhook', methods=['POST'])
+def telegram_webhook():
+    update = request.get_json()
+    if 'message' not in update: return "OK", 200
 
+    if not _UPDATE_SLOTS.acquire(blocking=False):
+        logging.warning("All update slots are busy; asking Telegram to retry.")
+        return "Busy", 503
+    _UPDATE_EXEC.submit(_handle_update_safely, update)
     return "OK", 200
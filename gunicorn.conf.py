@@ -0,0 +1,28 @@
+import os
+import sys
+
+wsgi_app = 'bridge:app'
+
+# The bridge only waits on I/O (Telegram, the worker, Redis), so cooperative
+# gevent workers can keep many updates in flight instead of one per OS thread.
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_connections = 500
+
+# Updates are acknowledged before they run, so a worker being stopped must be
+# given time to finish them: a worker call (5 s connect with retries + 90 s
+# read) plus the Telegram sends around it.
+graceful_timeout = 150
+
+def worker_exit(server, worker):
+    if bridge := sys.modules.get('bridge'):
+        bridge.drain_pending_updates()
+
+def post_fork(server, worker):
+    # bridge.py sizes its update pool from UPDATE_CONCURRENCY (default 16).
+    # Under gevent those pool threads are greenlets, so give them the worker's
+    # connection budget. This runs in the worker with command-line overrides
+    # applied and before bridge.py is imported (unless preload_app is set);
+    # an explicit UPDATE_CONCURRENCY always wins.
+    if 'UPDATE_CONCURRENCY' not in os.environ and type(worker).__module__ == 'gunicorn.workers.ggevent':
+        os.environ['UPDATE_CONCURRENCY'] = str(worker.cfg.worker_connections)